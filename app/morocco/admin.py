@@ -1,4 +1,34 @@
-from django.contrib import admin
-from .models import Setting
+from django.contrib import admin, messages
+from .models import Setting, Snapshot
+
+
+class SnapshotAdmin(admin.ModelAdmin):
+    list_display = ('short_sha', 'commit_author', 'commit_subject', 'commit_date', 'state', 'ignore')
+    list_filter = ('ignore', 'state')
+    search_fields = ('sha', 'commit_author')
+    ordering = ('-commit_date',)
+    actions = ['ignore_selected', 'refresh_selected', 'rebuild_selected']
+
+    def ignore_selected(self, request, queryset):
+        count = queryset.update(ignore=True)
+        self.message_user(request, '{} snapshots are ignored.'.format(count))
+    ignore_selected.short_description = 'Ignore selected snapshots'
+
+    def refresh_selected(self, request, queryset):
+        from .operation import refresh_snapshots
+        count = refresh_snapshots(list(queryset.values_list('sha', flat=True)))
+        self.message_user(request, '{} snapshots are refreshed.'.format(count))
+    refresh_selected.short_description = 'Refresh selected snapshots'
+
+    def rebuild_selected(self, request, queryset):
+        from .operation import rebuild_snapshots
+        submitted, deferred = rebuild_snapshots(list(queryset.values_list('sha', flat=True)), request)
+        self.message_user(request, '{} snapshots are rebuilding.'.format(len(submitted)))
+        if deferred:
+            self.message_user(request, 'Build pools are busy. Rebuild later: {}'.format(
+                ', '.join(sha[:7] for sha in deferred)), level=messages.WARNING)
+    rebuild_selected.short_description = 'Rebuild selected snapshots'
+
 
 admin.site.register(Setting)
+admin.site.register(Snapshot, SnapshotAdmin)
@@ -0,0 +1,9 @@
+from django import forms
+
+
+class SnapshotSearchForm(forms.Form):
+    q = forms.CharField(required=False, max_length=256, label='Message')
+    author = forms.CharField(required=False, max_length=128)
+    since = forms.DateField(required=False)
+    until = forms.DateField(required=False)
+    state = forms.CharField(required=False, max_length=32)
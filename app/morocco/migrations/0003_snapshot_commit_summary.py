@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Matches Snapshot.update_from_commit: the first line of the stripped message. The btrim characters are the ASCII
+# whitespace str.strip removes. Postgres escape strings have no \v, so the vertical tab is written as \x0b.
+FILL_COMMIT_SUMMARY = r"""
+UPDATE morocco_snapshot SET
+    short_sha = left(sha, 7),
+    commit_subject = left(split_part(btrim(commit_message, E' \t\n\r\f\x0b\x1c\x1d\x1e\x1f'), E'\n', 1), 256);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('morocco', '0002_auto_20170813_0715'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='commit_subject',
+            field=models.CharField(default='', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='short_sha',
+            field=models.CharField(db_index=True, default='', max_length=7),
+        ),
+        migrations.RunSQL(FILL_COMMIT_SUMMARY, migrations.RunSQL.noop),
+    ]
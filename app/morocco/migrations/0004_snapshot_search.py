@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+# The search vector is computed by the database so that it stays current no matter how a snapshot is written.
+# Subject, message and author are weighted so that matches in the subject rank first. Django saves every column on
+# update, so the update trigger only recomputes the vector when one of the indexed columns changed, or when the save
+# overwrites the vector itself. An instance that was inserted from Python still holds no vector and writes NULL back.
+CREATE_SEARCH_TRIGGER = """
+CREATE FUNCTION morocco_snapshot_search_vector(subject text, message text, author text) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('pg_catalog.english', coalesce(subject, '')), 'A') ||
+           setweight(to_tsvector('pg_catalog.english', coalesce(message, '')), 'B') ||
+           setweight(to_tsvector('pg_catalog.english', coalesce(author, '')), 'C');
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION morocco_snapshot_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := morocco_snapshot_search_vector(NEW.commit_subject, NEW.commit_message, NEW.commit_author);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER morocco_snapshot_search_vector_insert
+    BEFORE INSERT ON morocco_snapshot
+    FOR EACH ROW EXECUTE PROCEDURE morocco_snapshot_search_vector_update();
+
+CREATE TRIGGER morocco_snapshot_search_vector_update
+    BEFORE UPDATE ON morocco_snapshot
+    FOR EACH ROW
+    WHEN (OLD.commit_subject IS DISTINCT FROM NEW.commit_subject OR
+          OLD.commit_message IS DISTINCT FROM NEW.commit_message OR
+          OLD.commit_author IS DISTINCT FROM NEW.commit_author OR
+          OLD.search_vector IS DISTINCT FROM NEW.search_vector)
+    EXECUTE PROCEDURE morocco_snapshot_search_vector_update();
+
+UPDATE morocco_snapshot
+    SET search_vector = morocco_snapshot_search_vector(commit_subject, commit_message, commit_author);
+"""
+
+DROP_SEARCH_TRIGGER = """
+DROP TRIGGER IF EXISTS morocco_snapshot_search_vector_update ON morocco_snapshot;
+DROP TRIGGER IF EXISTS morocco_snapshot_search_vector_insert ON morocco_snapshot;
+DROP FUNCTION IF EXISTS morocco_snapshot_search_vector_update();
+DROP FUNCTION IF EXISTS morocco_snapshot_search_vector(text, text, text);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('morocco', '0003_snapshot_commit_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='state',
+            field=models.CharField(db_index=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='snapshot',
+            name='commit_author',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='snapshot',
+            name='commit_date',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='snapshot',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='snapshot_search_vector_gin'),
+        ),
+        migrations.RunSQL(CREATE_SEARCH_TRIGGER, DROP_SEARCH_TRIGGER),
+    ]
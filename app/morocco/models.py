@@ -1,7 +1,12 @@
 from datetime import datetime
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
+# the shortest abbreviated SHA a snapshot can be looked up by
+MIN_SHA_PREFIX = 4
+
 
 class Setting(models.Model):
     name = models.CharField(max_length=128)
@@ -13,10 +18,12 @@ class Setting(models.Model):
 
 class Snapshot(models.Model):
     sha = models.CharField(max_length=40)
+    short_sha = models.CharField(max_length=7, db_index=True, default='')
 
-    commit_author = models.CharField(max_length=128)
+    commit_author = models.CharField(max_length=128, db_index=True)
     commit_message = models.CharField(max_length=1024)
-    commit_date = models.DateTimeField()
+    commit_subject = models.CharField(max_length=256, default='')
+    commit_date = models.DateTimeField(db_index=True)
     commit_url = models.CharField(max_length=1024)
     ignore = models.BooleanField()
 
@@ -25,25 +32,41 @@ class Snapshot(models.Model):
     batch_job_last_update = models.DateTimeField(null=True)
 
     download_url = models.CharField(max_length=2048, null=True)
+    state = models.CharField(max_length=32, null=True, db_index=True)
+
+    # maintained by a database trigger from the commit subject, message and author. see migration 0004.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [GinIndex(fields=['search_vector'], name='snapshot_search_vector_gin')]
 
     def update_from_commit(self, commit_json) -> None:
         self.sha = commit_json['sha']
+        self.short_sha = self.sha[:7]
         self.commit_author = commit_json['commit']['author']['name'][:128]
         self.commit_date = datetime.strptime(commit_json['commit']['committer']['date'], '%Y-%m-%dT%H:%M:%SZ')
         self.commit_message = commit_json['commit']['message'][:1024]
+        self.commit_subject = self.commit_message.strip().split('\n')[0][:256]
         self.commit_url = commit_json['html_url'][:1024]
         if self.commit_author == 'azuresdkci':
             self.ignore = True
         else:
             self.ignore = False
 
-    @property
-    def short_sha(self) -> str:
-        return self.sha[:7]
-
-    @property
-    def commit_subject(self) -> str:
-        return self.commit_message.strip().split('\n')[0]
+    @classmethod
+    def filter_by_sha(cls, sha: str) -> models.QuerySet:
+        """
+        Match a full or abbreviated SHA. The prefix is resolved through the indexed short SHA column.
+
+        Prefixes shorter than MIN_SHA_PREFIX match nothing, since they would match too many commits to be useful.
+        """
+        if len(sha) < MIN_SHA_PREFIX:
+            return cls.objects.none()
+        if len(sha) >= 40:
+            return cls.objects.filter(sha=sha)
+        if len(sha) > 7:
+            return cls.objects.filter(short_sha=sha[:7], sha__startswith=sha)
+        return cls.objects.filter(short_sha__startswith=sha)
 
     @property
     def commit_date_str(self) ->str:
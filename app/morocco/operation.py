@@ -1,31 +1,79 @@
-from typing import List, Union, Tuple
+import tempfile
+import zlib
+from typing import List, Union, Tuple, Iterator
 from datetime import datetime, timedelta
 
-from azure.batch.models import MetadataItem, CloudJob, JobState
+from azure.batch.models import MetadataItem, CloudJob, CloudTask, JobState, TaskState, BatchErrorException
 from azure.storage.blob.models import BlobPermissions
 
-from django.db.models import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import ObjectDoesNotExist, Max
 from django.shortcuts import get_object_or_404, reverse
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, Http404
 
 from .models import Snapshot
-from .services import github, blob_storage, azure_batch
+from .services import (github, blob_storage, azure_batch, BuildPoolLoad, PoolCapacityError, BUILD_PRIORITY_HEAD,
+                       BUILD_PRIORITY_BACKFILL, TASK_FILE_CHUNK_SIZE)
+
+# the most rebuilds submitted by one bulk request. the rest are reported back as deferred.
+BULK_REBUILD_LIMIT = 20
+
+# the build task's log files, by the name they are requested with
+BUILD_LOG_FILES = {'stdout': 'stdout.txt', 'stderr': 'stderr.txt'}
+
+
+def get_head_commit_date() -> Union[datetime, None]:
+    return Snapshot.objects.filter(ignore=False).aggregate(Max('commit_date'))['commit_date__max']
+
+
+def get_build_priority(snapshot: Snapshot, head_commit_date: Union[datetime, None]) -> int:
+    # the newest commit not ignored is the branch HEAD. every older commit being rebuilt is a backfill.
+    is_head = head_commit_date is None or snapshot.commit_date >= head_commit_date
+    return BUILD_PRIORITY_HEAD if is_head else BUILD_PRIORITY_BACKFILL
 
 
 def rebuild_snapshot(sha: str, request: HttpRequest) -> Tuple[Snapshot, CloudJob]:
+    snapshot = get_object_or_404(Snapshot, sha=sha)
+    return _submit_build(snapshot, request, get_build_priority(snapshot, get_head_commit_date()))
+
+
+def rebuild_snapshots(shas: List[str], request: HttpRequest) -> Tuple[List[str], List[str]]:
+    """
+    Submit the rebuilds of many snapshots as one throttled batch. Returns the submitted and the deferred SHAs.
+
+    The build pools are inspected once for the whole batch. The newest commits are submitted first and at most
+    BULK_REBUILD_LIMIT builds are submitted per call. The batch stops when every build pool reaches its in-flight cap.
+    """
+    pool_loads = azure_batch.get_build_pool_loads()
+    head_commit_date = get_head_commit_date()
+    snapshots = list(Snapshot.objects.filter(sha__in=shas).order_by('-commit_date'))
+
+    submitted = []
+    for snapshot in snapshots[:BULK_REBUILD_LIMIT]:
+        try:
+            _submit_build(snapshot, request, get_build_priority(snapshot, head_commit_date), pool_loads)
+        except PoolCapacityError:
+            break
+        submitted.append(snapshot.sha)
+
+    deferred = [each.sha for each in snapshots if each.sha not in submitted]
+    return submitted, deferred
+
+
+def _submit_build(snapshot: Snapshot, request: HttpRequest, priority: int,
+                  pool_loads: List[BuildPoolLoad] = None) -> Tuple[Snapshot, CloudJob]:
     def get_api_endpoint(endpoint: str, **kwargs) -> str:
         if request:
             return request.build_absolute_uri(reverse(endpoint, kwargs=kwargs))
         else:
             return ''
 
-    snapshot = get_object_or_404(Snapshot, sha=sha)
     if snapshot.batch_job_id:
         job = azure_batch.get_job(snapshot.batch_job_id)
         if job and job.state != JobState.completed:
             return snapshot, job
 
-    job = azure_batch.create_build_job(sha, get_api_endpoint)
+    job = azure_batch.create_build_job(snapshot.sha, get_api_endpoint, priority=priority, pool_loads=pool_loads)
     snapshot.batch_job_id = job.id
     snapshot.batch_job_last_update = datetime.utcnow()
     snapshot.batch_job_create = job.creation_time
@@ -54,34 +102,158 @@ def refresh_snapshot(sha: str = None, commit: dict = None):
 
     if snapshot.batch_job_id:
         batch_job = azure_batch.get_job(snapshot.batch_job_id)
-        snapshot.batch_job_last_update = datetime.utcnow()
-        if batch_job:
-            # build job can be deleted. it is not required to keep data in sync
-            build_task = azure_batch.get_task(job_id=batch_job.id, task_id='build')
-            if build_task:
-                snapshot.state = build_task.state.value
-                snapshot.batch_job_id = batch_job.id
-                snapshot.batch_job_create = batch_job.creation_time
-        else:
-            snapshot.batch_job_id = None
-            snapshot.batch_job_create = None
+        build_task = azure_batch.get_task(job_id=batch_job.id, task_id='build') if batch_job else None
+        _update_build_state(snapshot, batch_job, build_task)
 
-    blob = 'azure-cli-{}.tar'.format(sha)
-    if blob_storage.exists(container_name='builds', blob_name=blob):
-        snapshot.download_url = blob_storage.make_blob_url(
-            'builds', blob_name=blob, protocol='https', sas_token=blob_storage.generate_blob_shared_access_signature(
-                'builds', blob, BlobPermissions(read=True), expiry=datetime.utcnow() + timedelta(days=365)))
+    if blob_storage.exists(container_name='builds', blob_name=_get_build_blob_name(sha)):
+        _update_download_url(snapshot)
 
     snapshot.save()
     return snapshot
 
 
+def refresh_snapshots(shas: List[str]) -> int:
+    """
+    Reconcile many known snapshots at once. Returns the number of snapshots refreshed.
+
+    The snapshots are read in one query and their jobs are looked up together. Everything is read from Batch and the
+    storage before the transaction starts, so the transaction only applies the changes and saves the snapshots. A
+    build task that can't be read leaves its snapshot's build state as it was without failing the batch.
+    """
+    snapshots = list(Snapshot.objects.filter(sha__in=shas))
+
+    job_creations = [each.batch_job_create for each in snapshots if each.batch_job_id]
+    created_after = min(job_creations) if job_creations and all(job_creations) else None
+    jobs = azure_batch.list_jobs((each.batch_job_id for each in snapshots if each.batch_job_id), created_after)
+
+    build_tasks = {}
+    for job_id in jobs:
+        try:
+            build_tasks[job_id] = azure_batch.get_task(job_id=job_id, task_id='build')
+        except BatchErrorException:
+            continue
+
+    built = set(each.sha for each in snapshots
+                if blob_storage.exists(container_name='builds', blob_name=_get_build_blob_name(each.sha)))
+
+    with transaction.atomic():
+        for snapshot in snapshots:
+            if snapshot.batch_job_id:
+                _update_build_state(snapshot, jobs.get(snapshot.batch_job_id), build_tasks.get(snapshot.batch_job_id))
+            if snapshot.sha in built:
+                _update_download_url(snapshot)
+            snapshot.save()
+
+    return len(snapshots)
+
+
+def _update_build_state(snapshot: Snapshot, batch_job: Union[CloudJob, None],
+                        build_task: Union[CloudTask, None]) -> None:
+    snapshot.batch_job_last_update = datetime.utcnow()
+    if batch_job:
+        # build job can be deleted. it is not required to keep data in sync
+        if build_task:
+            snapshot.state = build_task.state.value
+            snapshot.batch_job_id = batch_job.id
+            snapshot.batch_job_create = batch_job.creation_time
+    else:
+        snapshot.batch_job_id = None
+        snapshot.batch_job_create = None
+
+
+def _update_download_url(snapshot: Snapshot) -> None:
+    blob = _get_build_blob_name(snapshot.sha)
+    snapshot.download_url = blob_storage.make_blob_url(
+        'builds', blob_name=blob, protocol='https', sas_token=blob_storage.generate_blob_shared_access_signature(
+            'builds', blob, BlobPermissions(read=True), expiry=datetime.utcnow() + timedelta(days=365)))
+
+
+def _get_build_blob_name(sha: str) -> str:
+    return 'azure-cli-{}.tar'.format(sha)
+
+
 def ignore_snapshot(sha: str) -> None:
     snapshot = get_object_or_404(Snapshot, sha__exact=sha)
     snapshot.ignore = True
     snapshot.save()
 
 
+def ignore_snapshots(shas: List[str]) -> int:
+    return Snapshot.objects.filter(sha__in=shas).update(ignore=True)
+
+
+def stream_build_log(snapshot: Snapshot, name: str, offset: int = 0) -> Tuple[Iterator[bytes], Union[int, None]]:
+    """
+    Stream a log file of the snapshot's build task from the given byte offset.
+
+    Returns the log chunks and, while the task is still running, the offset to continue from on the next read. The log
+    of a completed task is compressed into the logs container as it is first streamed. Later reads are served from
+    there without calling Batch.
+    """
+    if not snapshot.batch_job_id or name not in BUILD_LOG_FILES:
+        raise Http404('No build log {} for snapshot {}.'.format(name, snapshot.sha))
+
+    file_path = BUILD_LOG_FILES[name]
+    blob = '{}/build/{}.gz'.format(snapshot.batch_job_id, file_path)
+    if blob_storage.exists(container_name='logs', blob_name=blob):
+        return _skip_to_offset(_read_cached_log(blob), offset), None
+
+    try:
+        task = azure_batch.get_task(job_id=snapshot.batch_job_id, task_id='build')
+        size = azure_batch.get_task_file_size(snapshot.batch_job_id, 'build', file_path)
+    except BatchErrorException:
+        raise Http404('Build log {} of job {} is not available.'.format(name, snapshot.batch_job_id))
+
+    if task.state != TaskState.completed:
+        return azure_batch.iter_task_file(snapshot.batch_job_id, 'build', file_path, min(offset, size), size), size
+
+    chunks = azure_batch.iter_task_file(snapshot.batch_job_id, 'build', file_path, 0, size)
+    return _skip_to_offset(_cache_log(chunks, blob), offset), None
+
+
+def _skip_to_offset(chunks: Iterator[bytes], offset: int) -> Iterator[bytes]:
+    position = 0
+    for chunk in chunks:
+        if position + len(chunk) > offset:
+            yield chunk[max(offset - position, 0):]
+        position += len(chunk)
+
+
+def _cache_log(chunks: Iterator[bytes], blob: str) -> Iterator[bytes]:
+    # the compressed copy is spooled to a temporary file and uploaded only once the whole log is read
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    with tempfile.TemporaryFile() as cache:
+        for chunk in chunks:
+            cache.write(compressor.compress(chunk))
+            yield chunk
+        cache.write(compressor.flush())
+
+        cache.seek(0)
+        blob_storage.create_container('logs', fail_on_exist=False)
+        blob_storage.create_blob_from_stream('logs', blob, cache)
+
+
+def _read_cached_log(blob: str) -> Iterator[bytes]:
+    # logs compress very well, so each compressed range is inflated in bounded steps rather than all at once
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    size = blob_storage.get_blob_properties('logs', blob).properties.content_length
+
+    for start in range(0, size, TASK_FILE_CHUNK_SIZE):
+        end = min(start + TASK_FILE_CHUNK_SIZE, size) - 1
+        data = blob_storage.get_blob_to_bytes('logs', blob, start_range=start, end_range=end).content
+        while True:
+            chunk = decompressor.decompress(data, TASK_FILE_CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+            if not data and len(chunk) < TASK_FILE_CHUNK_SIZE:
+                break
+
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
 def on_batch_callback(request: HttpRequest, sha: str) -> HttpResponse:
     data = request.POST.dict()
 
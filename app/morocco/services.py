@@ -3,18 +3,65 @@ import logging
 import os
 import base64
 from datetime import datetime, timedelta
-from typing import Callable, Union
+from typing import Callable, Union, List, Iterable, Iterator, Dict
 
 from azure.batch import BatchServiceClient
 from azure.batch.models import (TaskAddParameter, JobAddParameter, JobPreparationTask, JobManagerTask, PoolInformation,
                                 OutputFile, OutputFileDestination, OutputFileUploadOptions, OutputFileUploadCondition,
                                 OutputFileBlobContainerDestination, OnAllTasksComplete, EnvironmentSetting,
                                 ResourceFile, MetadataItem, CloudJob, CloudTask, CloudPool, TaskDependencies,
-                                BatchErrorException)
+                                BatchErrorException, JobListOptions, TaskListOptions, TaskState,
+                                FileGetFromTaskOptions)
 from azure.storage.blob import ContainerPermissions, BlockBlobService
 
 from .models import Setting
 
+# Batch job priorities range from -1000 to 1000. Builds of the branch HEAD are what people are waiting on, so they are
+# scheduled ahead of any backfill build queued in the same pool.
+BUILD_PRIORITY_HEAD = 500
+BUILD_PRIORITY_BACKFILL = -500
+
+# the most jobs looked up one by one before a single filtered listing is cheaper
+LIST_JOBS_THRESHOLD = 5
+
+# the size of each ranged read of a task file
+TASK_FILE_CHUNK_SIZE = 1024 * 1024
+
+
+def get_optional_setting(name: str, default: str) -> str:
+    setting = Setting.objects.filter(name__exact=name).first()
+    return setting.value if setting else default
+
+
+class PoolCapacityError(EnvironmentError):
+    pass
+
+
+class BuildPoolLoad(object):
+    """Point-in-time view of the work queued and running in one build pool."""
+
+    def __init__(self, pool: CloudPool):
+        self.pool = pool
+        self.jobs = 0
+        self.queued_tasks = 0
+        self.running_tasks = 0
+
+    @property
+    def slots(self) -> int:
+        nodes = (self.pool.current_dedicated_nodes or 0) + (self.pool.current_low_priority_nodes or 0)
+        return nodes * (self.pool.max_tasks_per_node or 1)
+
+    @property
+    def load(self) -> float:
+        # a pool without nodes is either resizing or scaled to zero. it can still accept jobs but it is the last choice.
+        if not self.slots:
+            return float('inf')
+        return (self.queued_tasks + self.running_tasks) / self.slots
+
+    def __str__(self):
+        return f'<Pool {self.pool.id}: {self.jobs} jobs, {self.queued_tasks} queued, {self.running_tasks} running, ' \
+               f'{self.slots} slots>'
+
 
 class GithubService(object):
     def __init__(self):
@@ -63,13 +110,67 @@ class AzureBatchClient(object):
         self.logger = logging.getLogger(AzureBatchClient.__name__)
         self.source = source_control
         self.storage = storage
+        self.max_jobs_per_pool = int(get_optional_setting('BATCH_POOL_MAX_JOBS', '10'))
 
     def get_batch_pool(self, usage: str) -> CloudPool:
-        for pool in self.client.pool.list():
-            if next(m.value for m in pool.metadata if m.name == 'usage') == usage:
-                return pool
+        pools = self.get_batch_pools(usage)
+        if not pools:
+            raise EnvironmentError('Fail to find a pool.')
+        return pools[0]
+
+    def get_batch_pools(self, usage: str) -> List[CloudPool]:
+        return [pool for pool in self.client.pool.list()
+                if any(m.name == 'usage' and m.value == usage for m in pool.metadata or [])]
+
+    def get_build_pool_loads(self) -> List[BuildPoolLoad]:
+        """
+        Count the active build jobs in every build pool together with the tasks they have queued or running.
+
+        This costs one pool listing, one listing of the active jobs, and one listing of unfinished tasks for each active
+        job in a build pool, whoever created it. HEAD builds are not held to the in-flight cap, so the number of task
+        listings can exceed it. Only completed jobs from the history are filtered out on the server.
+        """
+        loads = {pool.id: BuildPoolLoad(pool) for pool in self.get_batch_pools('build')}
+
+        active_jobs = self.client.job.list(JobListOptions(filter="state eq 'active'", select='id,poolInfo'))
+        for job in active_jobs:
+            load = loads.get(job.pool_info.pool_id if job.pool_info else None)
+            if not load:
+                continue
+
+            load.jobs += 1
+            unfinished_tasks = self.client.task.list(job.id, TaskListOptions(filter="state ne 'completed'",
+                                                                             select='id,state'))
+            for task in unfinished_tasks:
+                if task.state == TaskState.active:
+                    load.queued_tasks += 1
+                else:
+                    load.running_tasks += 1
+
+        return list(loads.values())
+
+    def select_build_pool(self, priority: int, pool_loads: List[BuildPoolLoad] = None) -> BuildPoolLoad:
+        """
+        Pick the least loaded build pool for a new job.
+
+        Pools already holding the maximum number of in-flight jobs are skipped. HEAD builds are never turned away: when
+        every pool is full they go to the least loaded one and rely on the job priority to jump the queue. Backfill
+        builds raise PoolCapacityError instead so the caller can retry later.
+        """
+        pool_loads = pool_loads if pool_loads is not None else self.get_build_pool_loads()
+        if not pool_loads:
+            self.logger.error('Cannot find a build pool. Please check the pools list in config file.')
+            raise ValueError('Fail to find a build pool.')
 
-        raise EnvironmentError('Fail to find a pool.')
+        candidates = [each for each in pool_loads if each.jobs < self.max_jobs_per_pool]
+        if not candidates:
+            if priority < BUILD_PRIORITY_HEAD:
+                raise PoolCapacityError('All build pools have reached {} in-flight jobs.'.format(self.max_jobs_per_pool))
+            candidates = pool_loads
+
+        selected = min(candidates, key=lambda each: (each.load, each.jobs))
+        self.logger.info('Selected build pool %s among %s', selected, ', '.join(str(each) for each in pool_loads))
+        return selected
 
     def get_job(self, job_id: str) -> Union[CloudJob, None]:
         try:
@@ -77,13 +178,45 @@ class AzureBatchClient(object):
         except BatchErrorException:
             return None
 
+    def list_jobs(self, job_ids: Iterable[str], created_after: datetime = None) -> Dict[str, CloudJob]:
+        """
+        Look up many build jobs. Deleted jobs are absent from the result.
+
+        A few jobs are read one by one. More than that are read in one listing, which is narrowed on the server to the
+        build jobs created since created_after so that its cost doesn't grow with the job history.
+        """
+        job_ids = set(job_ids)
+        if len(job_ids) <= LIST_JOBS_THRESHOLD:
+            jobs = (self.get_job(job_id) for job_id in job_ids)
+            return {job.id: job for job in jobs if job}
+
+        job_filter = "startswith(id,'build-')"
+        if created_after:
+            job_filter += " and creationTime ge datetime'{}'".format(created_after.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+        jobs = self.client.job.list(JobListOptions(filter=job_filter, select='id,state,creationTime'))
+        return {job.id: job for job in jobs if job.id in job_ids}
+
     def delete_job(self, job_id: str) -> None:
         self.client.job.delete(job_id)
 
     def get_task(self, job_id: str, task_id: str) -> CloudTask:
         return self.client.task.get(job_id=job_id, task_id=task_id)
 
-    def create_build_job(self, commit_sha: str, get_api_endpoint: Callable) -> CloudJob:
+    def get_task_file_size(self, job_id: str, task_id: str, file_path: str) -> int:
+        response = self.client.file.get_properties_from_task(job_id, task_id, file_path, raw=True)
+        return int(response.headers['Content-Length'])
+
+    def iter_task_file(self, job_id: str, task_id: str, file_path: str, start: int, end: int) -> Iterator[bytes]:
+        """Read the bytes from start up to end of a task file in ranged requests, so that it is never loaded whole."""
+        while start < end:
+            stop = min(start + TASK_FILE_CHUNK_SIZE, end)
+            options = FileGetFromTaskOptions(ocp_range=f'bytes={start}-{stop - 1}')
+            yield from self.client.file.get_from_task(job_id, task_id, file_path, file_get_from_task_options=options)
+            start = stop
+
+    def create_build_job(self, commit_sha: str, get_api_endpoint: Callable, priority: int = BUILD_PRIORITY_BACKFILL,
+                         pool_loads: List[BuildPoolLoad] = None) -> CloudJob:
         """
         Schedule a build job in the given pool. returns the container for build output and job reference.
 
@@ -93,13 +226,13 @@ class AzureBatchClient(object):
         or the test package is ready then.
 
         The parameter request is required to generate absolute uri to the api endpoint
+
+        The job is sent to the least loaded build pool. Callers submitting several jobs in a row can pass the result of
+        get_build_pool_loads as pool_loads; it is updated in place so the pools don't have to be listed again.
         """
         remote_source_dir = 'gitsrc'
-        pool = self.get_batch_pool('build')
-
-        if not pool:
-            self.logger.error('Cannot find a build pool. Please check the pools list in config file.')
-            raise ValueError('Fail to find a build pool.')
+        pool_load = self.select_build_pool(priority, pool_loads)
+        pool = pool_load.pool
 
         # secret is a random string used to verify the identity of caller when one task requests the service to do
         # something. the secret is saved to the job definition as metadata, and it is passed to some tasks as well.
@@ -113,9 +246,10 @@ class AzureBatchClient(object):
         timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
         job_id = f'build-{commit_sha}-{timestamp}'
 
-        self.logger.info('Creating build job %s in pool %s', job_id, pool.id)
+        self.logger.info('Creating build job %s in pool %s with priority %d', job_id, pool.id, priority)
         self.client.job.add(JobAddParameter(id=job_id,
                                             pool_info=PoolInformation(pool.id),
+                                            priority=priority,
                                             on_all_tasks_complete=OnAllTasksComplete.terminate_job,
                                             metadata=job_metadata,
                                             uses_task_dependencies=True))
@@ -155,6 +289,9 @@ class AzureBatchClient(object):
         self.client.task.add(job_id, report_task)
         self.logger.info('Build task is added to job %s', job_id)
 
+        pool_load.jobs += 1
+        pool_load.queued_tasks += 2
+
         return self.client.job.get(job_id)
 
     def _get_build_blob_container_url(self) -> str:
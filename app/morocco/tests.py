@@ -1,3 +1,321 @@
+from importlib import import_module
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib import messages
+from django.contrib.messages import get_messages
+from django.db import connection
+from django.shortcuts import reverse
+from django.utils import timezone
 from django.test import TestCase
 
-# Create your tests here.
+from .models import Setting, Snapshot
+
+TEST_SETTINGS = {
+    'GITHUB_SOURCE_URL': 'https://github.com/Azure/azure-cli.git',
+    'GITHUB_CLIENT_ID': 'client-id',
+    'GITHUB_CLIENT_SECRET': 'client-secret',
+    'BATCH_ACCOUNT': 'batch',
+    'BATCH_ACCOUNT_KEY': 'a2V5',
+    'BATCH_ACCOUNT_ENDPOINT': 'https://batch.example.com',
+    'STORAGE_ACCOUNT': 'storage',
+    'STORAGE_ACCOUNT_KEY': 'a2V5',
+}
+
+
+def make_snapshot(sha: str, message: str = 'Fix the build\n\nDetails of the fix.',
+                  date: str = '2017-08-13T07:15:00Z') -> Snapshot:
+    snapshot = Snapshot()
+    snapshot.update_from_commit({'sha': sha,
+                                 'html_url': 'https://github.com/Azure/azure-cli/commit/' + sha,
+                                 'commit': {'author': {'name': 'author'},
+                                            'committer': {'date': date},
+                                            'message': message}})
+    snapshot.save()
+    return snapshot
+
+
+class SnapshotLookupTest(TestCase):
+    def setUp(self):
+        make_snapshot('abcd' + '1' * 36)
+        make_snapshot('abcd' + '2' * 36)
+
+    def test_commit_summary(self):
+        snapshot = Snapshot.objects.get(sha='abcd' + '1' * 36)
+        self.assertEqual(snapshot.short_sha, 'abcd111')
+        self.assertEqual(snapshot.commit_subject, 'Fix the build')
+
+    def test_filter_by_sha(self):
+        self.assertEqual(Snapshot.filter_by_sha('abcd' + '1' * 36).count(), 1)
+        self.assertEqual(Snapshot.filter_by_sha('abcd2222').count(), 1)
+        self.assertEqual(Snapshot.filter_by_sha('abcd').count(), 2)
+        self.assertEqual(Snapshot.filter_by_sha('abc').count(), 0)
+
+    def test_unique_prefix_redirects_to_full_sha(self):
+        response = self.client.get(reverse('morocco:snapshot', kwargs={'sha': 'abcd1'}))
+        self.assertRedirects(response, reverse('morocco:snapshot', kwargs={'sha': 'abcd' + '1' * 36}),
+                             fetch_redirect_response=False)
+
+    def test_ambiguous_or_short_prefix_not_found(self):
+        self.assertEqual(self.client.get(reverse('morocco:snapshot', kwargs={'sha': 'abcd'})).status_code, 404)
+        self.assertEqual(self.client.get(reverse('morocco:snapshot', kwargs={'sha': 'ab'})).status_code, 404)
+
+    def test_backfill_matches_update_from_commit(self):
+        messages = ['version bump\n\nbump the v', '\x0b\t version 2\r\nsecond line\f', 'v']
+        expected = {}
+        for index, message in enumerate(messages):
+            snapshot = make_snapshot('{}'.format(index) * 40, message=message)
+            expected[snapshot.sha] = (snapshot.short_sha, snapshot.commit_subject)
+
+        Snapshot.objects.update(short_sha='', commit_subject='')
+        with connection.cursor() as cursor:
+            cursor.execute(import_module('morocco.migrations.0003_snapshot_commit_summary').FILL_COMMIT_SUMMARY)
+
+        for sha, summary in expected.items():
+            snapshot = Snapshot.objects.get(sha=sha)
+            self.assertEqual((snapshot.short_sha, snapshot.commit_subject), summary)
+
+
+class SearchViewTest(TestCase):
+    def setUp(self):
+        built = make_snapshot('1' * 40)
+        built.state = 'completed'
+        built.save()
+        make_snapshot('2' * 40)
+
+    def search(self, **params):
+        response = self.client.get(reverse('morocco:search_snapshots'), params)
+        return [each.sha for each in response.context['data']]
+
+    def test_filter_by_state(self):
+        self.assertEqual(self.search(state='completed'), ['1' * 40])
+
+    def test_filter_snapshots_never_built(self):
+        self.assertEqual(self.search(state='none'), ['2' * 40])
+
+    def test_full_text_query(self):
+        self.assertEqual(len(self.search(q='fix')), 2)
+        self.assertEqual(self.search(q='unrelated'), [])
+
+    def test_unchanged_saves_keep_search_vector(self):
+        snapshot = make_snapshot('3' * 40, message='Upgrade the packaging scripts')
+        snapshot.save()
+        snapshot.save()
+        Snapshot.objects.get(sha='3' * 40).save()
+
+        self.assertEqual(self.search(q='packaging'), ['3' * 40])
+
+
+class ServicesTestCase(TestCase):
+    """The service clients are created from the settings when their module is first imported."""
+
+    @classmethod
+    def setUpTestData(cls):
+        for name, value in TEST_SETTINGS.items():
+            Setting.objects.create(name=name, value=value)
+
+    def setUp(self):
+        from . import services
+        self.services = services
+
+
+class SelectBuildPoolTest(ServicesTestCase):
+    def setUp(self):
+        super(SelectBuildPoolTest, self).setUp()
+        self.batch = self.services.AzureBatchClient(self.services.github, self.services.blob_storage)
+        self.batch.max_jobs_per_pool = 2
+
+    def make_load(self, pool_id: str, nodes: int, jobs: int, queued_tasks: int = 0, running_tasks: int = 0):
+        pool = SimpleNamespace(id=pool_id, current_dedicated_nodes=nodes, current_low_priority_nodes=0,
+                               max_tasks_per_node=1)
+        load = self.services.BuildPoolLoad(pool)
+        load.jobs = jobs
+        load.queued_tasks = queued_tasks
+        load.running_tasks = running_tasks
+        return load
+
+    def test_select_least_loaded_pool(self):
+        busy = self.make_load('busy', nodes=2, jobs=1, queued_tasks=1, running_tasks=2)
+        idle = self.make_load('idle', nodes=2, jobs=1, running_tasks=1)
+
+        selected = self.batch.select_build_pool(self.services.BUILD_PRIORITY_BACKFILL, [busy, idle])
+        self.assertIs(selected, idle)
+
+    def test_skip_pool_at_cap(self):
+        full = self.make_load('full', nodes=10, jobs=2, running_tasks=2)
+        busy = self.make_load('busy', nodes=1, jobs=1, queued_tasks=1, running_tasks=1)
+
+        selected = self.batch.select_build_pool(self.services.BUILD_PRIORITY_BACKFILL, [full, busy])
+        self.assertIs(selected, busy)
+
+    def test_head_build_bypasses_cap(self):
+        full = self.make_load('full', nodes=1, jobs=2, queued_tasks=2, running_tasks=1)
+        less_full = self.make_load('less-full', nodes=4, jobs=2, running_tasks=2)
+
+        selected = self.batch.select_build_pool(self.services.BUILD_PRIORITY_HEAD, [full, less_full])
+        self.assertIs(selected, less_full)
+
+    def test_backfill_build_rejected_when_all_pools_at_cap(self):
+        loads = [self.make_load('full', nodes=1, jobs=2), self.make_load('also-full', nodes=4, jobs=3)]
+
+        with self.assertRaises(self.services.PoolCapacityError):
+            self.batch.select_build_pool(self.services.BUILD_PRIORITY_BACKFILL, loads)
+
+    def test_pool_without_nodes_is_last_choice(self):
+        empty = self.make_load('empty', nodes=0, jobs=0)
+        busy = self.make_load('busy', nodes=1, jobs=1, queued_tasks=3, running_tasks=1)
+
+        selected = self.batch.select_build_pool(self.services.BUILD_PRIORITY_BACKFILL, [empty, busy])
+        self.assertIs(selected, busy)
+
+
+class FakeBlobStorage(object):
+    def __init__(self):
+        self.blobs = {}
+
+    def create_container(self, container_name, fail_on_exist=True):
+        pass
+
+    def create_blob_from_stream(self, container_name, blob_name, stream):
+        self.blobs[blob_name] = stream.read()
+
+    def get_blob_properties(self, container_name, blob_name):
+        return SimpleNamespace(properties=SimpleNamespace(content_length=len(self.blobs[blob_name])))
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range, end_range):
+        return SimpleNamespace(content=self.blobs[blob_name][start_range:end_range + 1])
+
+
+class BuildLogTest(ServicesTestCase):
+    def setUp(self):
+        super(BuildLogTest, self).setUp()
+        from . import operation
+        self.operation = operation
+        self.storage = FakeBlobStorage()
+
+        patches = [mock.patch.object(operation, 'blob_storage', self.storage),
+                   mock.patch.object(operation, 'TASK_FILE_CHUNK_SIZE', 1024)]
+        for each in patches:
+            each.start()
+            self.addCleanup(each.stop)
+
+    def test_skip_to_offset(self):
+        chunks = [b'abcd', b'efgh', b'ij']
+        skip = self.operation._skip_to_offset
+
+        self.assertEqual(b''.join(skip(iter(chunks), 0)), b'abcdefghij')
+        self.assertEqual(list(skip(iter(chunks), 6)), [b'gh', b'ij'])
+        self.assertEqual(list(skip(iter(chunks), 4)), [b'efgh', b'ij'])
+        self.assertEqual(list(skip(iter(chunks), 10)), [])
+        self.assertEqual(list(skip(iter(chunks), 100)), [])
+
+    def test_cache_log_uploads_after_last_chunk(self):
+        log = b''.join(b'line %d\n' % i for i in range(1000))
+        chunks = [log[i:i + 700] for i in range(0, len(log), 700)]
+
+        streamed = self.operation._cache_log(iter(chunks), 'job/build/stdout.txt.gz')
+        self.assertEqual(next(streamed), chunks[0])
+        self.assertNotIn('job/build/stdout.txt.gz', self.storage.blobs)
+
+        self.assertEqual(chunks[0] + b''.join(streamed), log)
+        self.assertIn('job/build/stdout.txt.gz', self.storage.blobs)
+        self.assertLess(len(self.storage.blobs['job/build/stdout.txt.gz']), len(log))
+
+    def test_read_cached_log_in_bounded_chunks(self):
+        log = b'the same build output line\n' * 100000
+        list(self.operation._cache_log(iter([log]), 'job/build/stdout.txt.gz'))
+
+        chunks = list(self.operation._read_cached_log('job/build/stdout.txt.gz'))
+        self.assertEqual(b''.join(chunks), log)
+        self.assertLessEqual(max(len(each) for each in chunks), 1024)
+
+    def test_read_cached_log_from_offset(self):
+        log = b''.join(b'line %d\n' % i for i in range(5000))
+        list(self.operation._cache_log(iter([log]), 'job/build/stderr.txt.gz'))
+        read = self.operation._read_cached_log
+
+        self.assertEqual(b''.join(self.operation._skip_to_offset(read('job/build/stderr.txt.gz'), 1500)), log[1500:])
+        self.assertEqual(b''.join(self.operation._skip_to_offset(read('job/build/stderr.txt.gz'), len(log) + 1)), b'')
+
+
+class BulkOperationTest(ServicesTestCase):
+    def setUp(self):
+        super(BulkOperationTest, self).setUp()
+        from . import operation
+        self.operation = operation
+        self.batch = mock.MagicMock()
+        self.batch.get_build_pool_loads.return_value = []
+        self.storage = mock.MagicMock()
+        self.storage.exists.return_value = False
+
+        patches = [mock.patch.object(operation, 'azure_batch', self.batch),
+                   mock.patch.object(operation, 'blob_storage', self.storage)]
+        for each in patches:
+            each.start()
+            self.addCleanup(each.stop)
+
+        self.oldest = make_snapshot('1' * 40, date='2017-08-11T00:00:00Z').sha
+        self.middle = make_snapshot('2' * 40, date='2017-08-12T00:00:00Z').sha
+        self.newest = make_snapshot('3' * 40, date='2017-08-13T00:00:00Z').sha
+
+    def make_job(self, sha: str, *args, **kwargs):
+        return SimpleNamespace(id='build-' + sha, creation_time=timezone.now())
+
+    def make_batch_error(self):
+        from azure.batch.models import BatchErrorException
+        return BatchErrorException.__new__(BatchErrorException)
+
+    def test_ignore_snapshots_in_one_update(self):
+        with self.assertNumQueries(1):
+            count = self.operation.ignore_snapshots([self.oldest, self.newest, 'f' * 40])
+
+        self.assertEqual(count, 2)
+        self.assertEqual(set(Snapshot.objects.filter(ignore=True).values_list('sha', flat=True)),
+                         {self.oldest, self.newest})
+
+    def test_rebuild_snapshots_newest_first_up_to_limit(self):
+        self.batch.create_build_job.side_effect = self.make_job
+
+        with mock.patch.object(self.operation, 'BULK_REBUILD_LIMIT', 2):
+            submitted, deferred = self.operation.rebuild_snapshots([self.oldest, self.newest, self.middle], None)
+
+        self.assertEqual(submitted, [self.newest, self.middle])
+        self.assertEqual(deferred, [self.oldest])
+        priorities = [call[1]['priority'] for call in self.batch.create_build_job.call_args_list]
+        self.assertEqual(priorities, [self.services.BUILD_PRIORITY_HEAD, self.services.BUILD_PRIORITY_BACKFILL])
+        self.assertEqual(Snapshot.objects.get(sha=self.newest).batch_job_id, 'build-' + self.newest)
+
+    def test_rebuild_snapshots_stop_when_pools_are_full(self):
+        self.batch.create_build_job.side_effect = [self.make_job(self.newest), self.services.PoolCapacityError()]
+
+        submitted, deferred = self.operation.rebuild_snapshots([self.oldest, self.middle, self.newest], None)
+
+        self.assertEqual(submitted, [self.newest])
+        self.assertEqual(deferred, [self.middle, self.oldest])
+        self.assertEqual(self.batch.create_build_job.call_count, 2)
+
+    def test_refresh_snapshots(self):
+        Snapshot.objects.filter(sha=self.oldest).update(batch_job_id='build-deleted', state='running')
+        Snapshot.objects.filter(sha=self.newest).update(batch_job_id='build-unreadable', state='running')
+        self.batch.list_jobs.return_value = {'build-unreadable': self.make_job('unreadable')}
+        self.batch.get_task.side_effect = self.make_batch_error()
+
+        self.assertEqual(self.operation.refresh_snapshots([self.oldest, self.newest]), 2)
+
+        deleted = Snapshot.objects.get(sha=self.oldest)
+        self.assertIsNone(deleted.batch_job_id)
+        unreadable = Snapshot.objects.get(sha=self.newest)
+        self.assertEqual(unreadable.batch_job_id, 'build-unreadable')
+        self.assertEqual(unreadable.state, 'running')
+
+    def test_bulk_update_without_selection(self):
+        response = self.client.post(reverse('morocco:bulk_update_snapshots'), {'action': 'ignore'})
+
+        self.assertRedirects(response, reverse('morocco:snapshots'), fetch_redirect_response=False)
+        self.assertEqual([each.level for each in get_messages(response.wsgi_request)], [messages.WARNING])
+        self.assertFalse(Snapshot.objects.filter(ignore=True).exists())
+
+    def test_bulk_update_unknown_action(self):
+        response = self.client.post(reverse('morocco:bulk_update_snapshots'),
+                                    {'action': 'delete', 'sha': [self.oldest]})
+        self.assertEqual(response.status_code, 400)
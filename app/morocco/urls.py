@@ -5,8 +5,11 @@ app_name = 'morocco'
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^snapshots/', views.IndexView.as_view(), name='snapshots'),
+    url(r'^search/snapshots/', views.SearchView.as_view(), name='search_snapshots'),
     url(r'^snapshot/(?P<sha>[a-z0-9]+)$', views.snapshot, name='snapshot'),
+    url(r'^snapshot/(?P<sha>[a-z0-9]+)/(?P<name>stdout|stderr)$', views.snapshot_log, name='snapshot_log'),
     url(r'^sync/snapshots/', views.sync_snapshots, name='sync_snapshots'),
+    url(r'^update/snapshots/$', views.BulkUpdateSnapshots.as_view(), name='bulk_update_snapshots'),
     url(r'^update/snapshots/(?P<sha>[a-z0-9]+)$', views.UpdateSnapshot.as_view(), name='update_snapshot'),
     url(r'^api/snapshot/(?P<sha>[a-z0-9]+)$', views.ApiUpdateSnapshot.as_view(), name='api_update_snapshot'),
     url(r'^manager/', views.manager, name='manager')
@@ -2,10 +2,13 @@ from django.shortcuts import render, redirect, get_object_or_404, reverse
 from django.views import generic
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 
 from .models import Snapshot
 
+# the state filter value selecting the snapshots that have never been built
+NO_STATE = 'none'
+
 
 class IndexView(generic.ListView):
     template_name = 'morocco/snapshots.html'
@@ -13,17 +16,76 @@ class IndexView(generic.ListView):
 
     def get_queryset(self):
         """Return the last five published questions."""
-        return Snapshot.objects.filter(ignore=False).order_by('-commit_date')
+        return Snapshot.objects.filter(ignore=False).order_by('-commit_date') \
+            .only('sha', 'short_sha', 'commit_author', 'commit_subject', 'commit_date')
+
+
+class SearchView(generic.ListView):
+    template_name = 'morocco/search.html'
+    context_object_name = 'data'
+    paginate_by = 50
+
+    def get_queryset(self):
+        """Return the snapshots matching the search form, best match first."""
+        from datetime import timedelta
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+        from django.db.models import F, Count
+        from .forms import SnapshotSearchForm
+
+        self.form = SnapshotSearchForm(self.request.GET)
+        self.facets = []
+
+        queryset = Snapshot.objects.filter(ignore=False) \
+            .only('sha', 'short_sha', 'commit_author', 'commit_subject', 'commit_date', 'state')
+        if not self.form.is_valid():
+            return queryset.none()
+
+        criteria = self.form.cleaned_data
+        if criteria['author']:
+            queryset = queryset.filter(commit_author=criteria['author'])
+        if criteria['since']:
+            queryset = queryset.filter(commit_date__gte=criteria['since'])
+        if criteria['until']:
+            queryset = queryset.filter(commit_date__lt=criteria['until'] + timedelta(days=1))
+
+        query = SearchQuery(criteria['q'], config='english') if criteria['q'] else None
+        if query:
+            queryset = queryset.filter(search_vector=query)
+
+        # the state facet counts the matches of every other criteria so that it shows where a state filter leads
+        self.facets = queryset.order_by('state').values('state').annotate(count=Count('id'))
+        if criteria['state'] == NO_STATE:
+            queryset = queryset.filter(state__isnull=True)
+        elif criteria['state']:
+            queryset = queryset.filter(state=criteria['state'])
+
+        if query:
+            return queryset.annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', '-commit_date')
+        return queryset.order_by('-commit_date')
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        context.update({'title': 'Search', 'form': self.form, 'facets': self.facets, 'params': params.urlencode(),
+                        'no_state': NO_STATE})
+        params.pop('state', None)
+        context['facet_params'] = params.urlencode()
+        return context
 
 
 class UpdateSnapshot(generic.View):
     def post(self, request, sha):
         from .operation import ignore_snapshot, rebuild_snapshot, refresh_snapshot
+        from .services import PoolCapacityError
         action = request.POST.get('action')
         if action == 'refresh':
             refresh_snapshot(sha)
         elif action == 'rebuild':
-            rebuild_snapshot(sha, request)
+            try:
+                rebuild_snapshot(sha, request)
+            except PoolCapacityError as error:
+                return HttpResponse(content=str(error), status=503)
         elif action == 'ignore':
             ignore_snapshot(sha)
         else:
@@ -32,6 +94,30 @@ class UpdateSnapshot(generic.View):
         return redirect('morocco:snapshot', sha=sha)
 
 
+class BulkUpdateSnapshots(generic.View):
+    def post(self, request):
+        from django.contrib import messages
+        from .operation import ignore_snapshots, rebuild_snapshots, refresh_snapshots
+        action = request.POST.get('action')
+        shas = request.POST.getlist('sha')
+        if not shas:
+            messages.warning(request, 'No snapshot is selected.')
+        elif action == 'refresh':
+            messages.info(request, '{} snapshots are refreshed.'.format(refresh_snapshots(shas)))
+        elif action == 'rebuild':
+            submitted, deferred = rebuild_snapshots(shas, request)
+            messages.info(request, '{} snapshots are rebuilding.'.format(len(submitted)))
+            if deferred:
+                messages.warning(request, 'Build pools are busy. Rebuild later: {}'.format(
+                    ', '.join(sha[:7] for sha in deferred)))
+        elif action == 'ignore':
+            messages.info(request, '{} snapshots are ignored.'.format(ignore_snapshots(shas)))
+        else:
+            return HttpResponse(content='Unknown action {}'.format(action or 'None'), status=400)
+
+        return redirect('morocco:snapshots')
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ApiUpdateSnapshot(generic.View):
     def post(self, request, sha):
@@ -78,12 +164,39 @@ def index(request):
 def snapshot(request, sha):
     from .models import Snapshot
 
-    data = get_object_or_404(Snapshot, sha=sha)
+    matches = list(Snapshot.filter_by_sha(sha)[:2])
+    if not matches:
+        raise Http404('No snapshot matches {}.'.format(sha))
+    if len(matches) > 1:
+        raise Http404('More than one snapshot matches {}. Use a longer SHA.'.format(sha))
+
+    data = matches[0]
+    if data.sha != sha:
+        return redirect('morocco:snapshot', sha=data.sha)
+
     cb = request.build_absolute_uri(reverse('morocco:api_update_snapshot', kwargs={'sha': sha}))
     return render(request, 'morocco/snapshot.html',
                   context={'title': 'Snapshot', 'data': data, 'cb': cb})
 
 
+def snapshot_log(request, sha, name):
+    from django.http import StreamingHttpResponse
+    from .operation import stream_build_log
+
+    offset = request.GET.get('offset', '0')
+    if not offset.isdigit():
+        return HttpResponse(content='Invalid offset {}'.format(offset), status=400)
+
+    data = get_object_or_404(Snapshot, sha=sha)
+    chunks, next_offset = stream_build_log(data, name, int(offset))
+
+    response = StreamingHttpResponse(chunks, content_type='text/plain; charset=utf-8')
+    if next_offset is not None:
+        # the build is still running. the client polls again from this offset to read the new output.
+        response['X-Log-Offset'] = str(next_offset)
+    return response
+
+
 def sync_snapshots(request):
     # Sync the latest 100 snapshots
     import requests